@@ -1,9 +1,13 @@
 import torch
 import os
 import json
+import functools
 from dataclasses import dataclass
 from typing import Dict, List, Union, Any
 
+import pyarrow as pa
+import pyarrow.parquet as pq
+from PIL import Image
 from datasets import load_dataset
 from transformers import (
     Qwen2VLForConditionalGeneration,
@@ -18,11 +22,12 @@ from peft import (
     prepare_model_for_kbit_training,
     TaskType
 )
-from qwen_vl_utils import process_vision_info
+from cache_pixels import CACHE_DIR, build_pixel_cache, load_cached_pixels
 
 # Hyper parameters
 MODEL_ID = "Qwen/Qwen2-VL-2B-Instruct"
 DATA_FILE = "./Degradation/train_data_augmented.json"
+PARQUET_FILE = "./Degradation/train_data_augmented.parquet"  # DATA_FILE에서 1회 변환 (mmap arrow 로드용)
 OUTPUT_DIR = "./checkpoints/qlora/degradation_agent_v1"
 
 # 3070 Ti (8GB) 맞춤 설정
@@ -31,6 +36,104 @@ LORA_RANK = 16
 LORA_ALPHA = 32
 LORA_DROPOUT = 0.05
 
+# Qwen2-VL 이미지 토큰 (processor가 image_grid_thw 크기만큼 확장)
+IMAGE_PAD_TOKEN = "<|image_pad|>"
+
+# 데이터셋 전처리 (로드 시 1회만 수행)
+@functools.lru_cache(maxsize=None)
+def get_processor(model_id: str = MODEL_ID) -> AutoProcessor:
+    """프로세스당 1회만 로드 (dataset.map 워커에서도 재사용)"""
+    return AutoProcessor.from_pretrained(model_id)
+
+def clean_messages(raw_messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    role에 따라 메세지 정리 -> 정리 안하면, assistant role까지 이미지로 처리해서 오류 생겼음
+    (json 로드 시 image/text 키가 None으로 채워지므로 None 값 제거)
+    """
+    return [
+        {
+            "role": msg["role"],
+            "content": [{k: v for k, v in item.items() if v is not None} for item in msg["content"]]
+            if isinstance(msg["content"], list) else msg["content"],
+        }
+        for msg in raw_messages
+    ]
+
+def template_key(messages: List[Dict[str, Any]]) -> tuple:
+    """
+    chat template 캐시 키. 이미지 경로는 템플릿 결과에 영향이 없으므로 제외합니다.
+    (고정 프롬프트 + 몇 가지 응답 -> 대부분 캐시 히트)
+    """
+    return tuple(
+        (msg["role"], tuple((item["type"], item.get("text")) for item in msg["content"]))
+        if isinstance(msg["content"], list) else (msg["role"], msg["content"])
+        for msg in messages
+    )
+
+@functools.lru_cache(maxsize=None)
+def render_chat_template(key: tuple, add_generation_prompt: bool = False, model_id: str = MODEL_ID) -> str:
+    """template_key로부터 메세지를 복원해서 chat template 렌더링"""
+    messages = []
+    for role, content in key:
+        if isinstance(content, tuple):
+            content = [
+                {"type": "image"} if item_type == "image" else {"type": item_type, "text": text}
+                for item_type, text in content
+            ]
+        messages.append({"role": role, "content": content})
+
+    return get_processor(model_id).apply_chat_template(
+        messages, tokenize=False, add_generation_prompt=add_generation_prompt
+    )
+
+@functools.lru_cache(maxsize=None)
+def prompt_token_length(key: tuple, model_id: str = MODEL_ID) -> int:
+    """
+    assistant 응답 직전까지의 토큰 수 (이미지 토큰은 확장 전 1개 기준)
+    마지막 assistant 메세지를 빼고 add_generation_prompt=True로 렌더링해서 계산합니다.
+    """
+    prompt_text = render_chat_template(key[:-1], add_generation_prompt=True, model_id=model_id)
+    return len(get_processor(model_id).tokenizer(prompt_text)["input_ids"])
+
+def preprocess_example(example: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    메세지 정리 + 프롬프트 렌더링을 미리 해둡니다.
+    collator에서는 processor 호출만 하도록 (배치마다 python dict 순회 X)
+    """
+    messages = clean_messages(example["messages"])
+    image_paths = [
+        item["image"]
+        for msg in messages if isinstance(msg["content"], list)
+        for item in msg["content"] if item["type"] == "image"
+    ]
+
+    # 이미지 헤더만 읽어서 면적(W*H) 계산 (디코딩 없음) -> group_by_length 버킷팅 기준
+    image_area = 0
+    for path in image_paths:
+        with Image.open(path) as img:
+            image_area += img.size[0] * img.size[1]
+
+    key = template_key(messages)
+    return {
+        "text": render_chat_template(key),
+        "response_start": prompt_token_length(key),
+        "image_paths": image_paths,
+        "image_area": image_area,
+    }
+
+def convert_to_parquet(json_file: str, parquet_file: str) -> None:
+    """
+    JSON 데이터셋을 Parquet으로 1회 변환합니다. (JSON이 더 최신이면 다시 변환)
+    Parquet은 arrow로 mmap 로드되어 dataloader 워커 간 메모리 페이지를 공유합니다.
+    """
+    if os.path.exists(parquet_file) and os.path.getmtime(parquet_file) >= os.path.getmtime(json_file):
+        return
+
+    print(f">>> Parquet 변환: {json_file} -> {parquet_file}")
+    with open(json_file, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    pq.write_table(pa.Table.from_pylist(data), parquet_file)
+
 # Custom Data Collator
 @dataclass
 class Qwen2VLDataCollator:
@@ -38,61 +141,78 @@ class Qwen2VLDataCollator:
     Qwen2-VL은 텍스트와 이미지를 동시에 처리해서 
     input_ids, pixel_values, image_grid_thw 등을 만들어야 합니다.
     이를 배치 단위로 묶어주는 역할을 합니다.
+    (텍스트는 preprocess_example에서 미리 렌더링, 이미지는 cache_pixels.py에서 미리 변환됨)
     """
     processor: AutoProcessor
+    cache_dir: str = CACHE_DIR  # 경로만 보관 -> 워커로 전달해도 캐시 데이터는 복사되지 않음
 
     def __call__(self, examples: List[Dict[str, Any]]) -> Dict[str, torch.Tensor]:
-        # 1. 텍스트와 이미지 데이터 추출
+        # 1. 텍스트와 캐시된 이미지 텐서 추출
+        merge_length = self.processor.image_processor.merge_size ** 2
         texts = []
-        image_inputs = []
-        
+        response_starts = []
+        pixel_values = []
+        image_grid_thw = []
+
         for example in examples:
-            raw_messages = example["messages"]
-
-            # role에 따라 메세지 정리 -> 정리 안하면, assistant role까지 이미지로 처리해서 오류(line 64) 생겼음
-            messages = []
-            for msg in raw_messages:
-                role = msg["role"]
-                content = msg["content"]
-
-                clean_content = []
-                if isinstance(content, list):
-                    for item in content:
-                        clean_item = {k: v for k, v in item.items() if v is not None}
-                        clean_content.append(clean_item)
-                else:
-                    clean_content = content
-
-                messages.append({"role": role, "content": clean_content})
-
-            # 프롬프트 처리 (Qwen-VL Utils 활용)
-            text = self.processor.apply_chat_template(
-                messages, tokenize=False, add_generation_prompt=False
-            )
-            texts.append(text)
-            
-            # 이미지 처리
-            image_input, video_input = process_vision_info(messages)
-            image_inputs.append(image_input)
-
-        # 2. Processor를 통해 텐서 변환 (Padding 적용)
-        batch = self.processor(
-            text=texts,
-            images=image_inputs,
+            text = example["text"]
+            response_start = example["response_start"]
+            for path in example["image_paths"]:
+                cached = load_cached_pixels(path, self.cache_dir)
+                pixel_values.append(cached["pixel_values"])
+                image_grid_thw.append(cached["image_grid_thw"])
+
+                # processor와 동일하게 이미지 토큰을 grid 크기만큼 확장
+                num_image_tokens = int(cached["image_grid_thw"].prod()) // merge_length
+                text = text.replace(IMAGE_PAD_TOKEN, "<|placeholder|>" * num_image_tokens, 1)
+                response_start += num_image_tokens - 1
+            texts.append(text.replace("<|placeholder|>", IMAGE_PAD_TOKEN))
+            response_starts.append(response_start)
+
+        # 2. 토크나이즈 (Padding 적용) + 이미지 텐서 결합
+        # torch.compile 재컴파일을 줄이기 위해 64 단위로만 패딩 (배치 최장 길이 기준)
+        # 이미지 토큰이 앞쪽에 있으므로 MAX_SEQ_LENGTH 초과 시 응답 뒷부분만 잘림
+        batch = self.processor.tokenizer(
+            texts,
             padding=True,
+            pad_to_multiple_of=64,
+            truncation=True,
+            max_length=MAX_SEQ_LENGTH,
             return_tensors="pt",
         )
+        batch["pixel_values"] = torch.cat(pixel_values, dim=0)
+        batch["image_grid_thw"] = torch.cat(image_grid_thw, dim=0)
 
         # 3. Label 생성
         # 기본적으로 input_ids를 복사, 패딩 토큰은 -100으로 마스킹해서 Loss 계산 제외
         labels = batch["input_ids"].clone()
         labels[labels == self.processor.tokenizer.pad_token_id] = -100
+
+        # 프롬프트(system/user + 이미지 토큰)도 마스킹 -> assistant 응답에서만 Loss 계산
+        # left padding이면 첫 실제 토큰 위치만큼 밀어서 적용
+        first_token_idx = batch["attention_mask"].argmax(dim=1)
+        for i, response_start in enumerate(response_starts):
+            labels[i, : first_token_idx[i] + response_start] = -100
         
         batch["labels"] = labels
         return batch
 
+def disable_torch_compile(training_args: TrainingArguments) -> None:
+    """
+    TrainingArguments의 torch.compile 설정을 끕니다. (eager fallback용)
+    accelerate는 dynamo 설정을 환경변수로도 읽으므로 같이 제거합니다.
+    """
+    training_args.torch_compile = False
+    training_args.torch_compile_mode = None
+    training_args.torch_compile_backend = None
+    os.environ.pop("ACCELERATE_DYNAMO_BACKEND", None)
+    os.environ.pop("ACCELERATE_DYNAMO_MODE", None)
+
 def train():
     print(f">>> 학습 준비 시작 (Device: {torch.cuda.get_device_name(0)})")
+
+    # Ampere TF32 matmul 허용 (bf16 학습에서는 남아있는 fp32 matmul에만 적용되어 효과는 작음)
+    torch.backends.cuda.matmul.allow_tf32 = True
     
     # A. 4-bit 양자화 설정 (QLoRA) - 3070ti를 위해 ㅜㅜ
     bnb_config = BitsAndBytesConfig(
@@ -100,21 +220,35 @@ def train():
         bnb_4bit_quant_type="nf4",
         bnb_4bit_compute_dtype=torch.bfloat16,
         bnb_4bit_use_double_quant=True,
+        bnb_4bit_quant_storage=torch.bfloat16,  # compute dtype와 맞춰 dequant 시 중간 cast 생략
     )
 
     # B. 모델 및 프로세서 로드
-    model = Qwen2VLForConditionalGeneration.from_pretrained(
-        MODEL_ID,
-        quantization_config=bnb_config,
-        device_map="auto",
-        # attn_implementation="flash_attention_2" # todo: flash attention적용 필요.. 윈도우에서 ㅠㅠ
-    )
+    # 윈도우는 prebuilt flash-attn wheel (torch/CUDA 12.x 맞춤) 설치 필요
+    try:
+        model = Qwen2VLForConditionalGeneration.from_pretrained(
+            MODEL_ID,
+            quantization_config=bnb_config,
+            device_map="auto",
+            attn_implementation="flash_attention_2"
+        )
+    except Exception as e:
+        print(f"Warning: Flash Attention 2 로드 실패. SDPA로 전환합니다. Error: {e}")
+        model = Qwen2VLForConditionalGeneration.from_pretrained(
+            MODEL_ID,
+            quantization_config=bnb_config,
+            device_map="auto",
+            attn_implementation="sdpa"
+        )
     
     # VRAM 넉넉한 곳에서는 아래 옵션 없이 테스트 해보기
-    model.gradient_checkpointing_enable()
-    model = prepare_model_for_kbit_training(model)
+    # non-reentrant checkpoint: frozen 비전 인코더처럼 grad 필요 없는 입력에서도 동작
+    # (비전 인코더는 LoRA 대상이 아니고 pixel_values도 grad가 없어서 역전파용 activation이 저장되지 않음)
+    gc_kwargs = {"use_reentrant": False}
+    model.gradient_checkpointing_enable(gradient_checkpointing_kwargs=gc_kwargs)
+    model = prepare_model_for_kbit_training(model, gradient_checkpointing_kwargs=gc_kwargs)
     
-    processor = AutoProcessor.from_pretrained(MODEL_ID)
+    processor = get_processor(MODEL_ID)
 
     # C. LoRA 어댑터 설정
     # Frozen : Vision Encoder
@@ -135,36 +269,67 @@ def train():
     
     # load dataset
     print(f">>> 데이터셋 로드: {DATA_FILE}")
-    dataset = load_dataset("json", data_files=DATA_FILE, split="train")
+    convert_to_parquet(DATA_FILE, PARQUET_FILE)
+    dataset = load_dataset("parquet", data_files=PARQUET_FILE, split="train")
+    # 메세지 정리 + 템플릿 렌더링 1회 수행 (text, image_paths, image_area 컬럼 생성)
+    dataset = dataset.map(
+        preprocess_example,
+        remove_columns=["messages"],
+        num_proc=os.cpu_count(),
+    )
+
+    # 이미지 전처리 결과를 이미지별 파일로 캐싱 (epoch마다 디코딩/resize 반복 X)
+    # collator가 필요한 이미지만 mmap으로 로드 -> 워커 수만큼 캐시가 복사되지 않음
+    image_paths = sorted({path for paths in dataset["image_paths"] for path in paths})
+    build_pixel_cache(image_paths, processor, CACHE_DIR)
 
     # Set trainer
     training_args = TrainingArguments(
         output_dir=OUTPUT_DIR,
-        per_device_train_batch_size=4,      
-        gradient_accumulation_steps=4,     
+        per_device_train_batch_size=4,      # 실제 배치 4 -> NF4 dequant 오버헤드 분산
+        gradient_accumulation_steps=4,      # 유효 배치 16 유지
         num_train_epochs=3,                 # 데이터가 적으므로 3~5 epoch
         learning_rate=2e-4,
         logging_steps=5,
         save_strategy="epoch",
         fp16=False,
         bf16=True,                          
-        optim="paged_adamw_8bit",           # 옵티마이저 메모리 절약
+        optim="paged_adamw_8bit",           # 옵티마이저 메모리 절약 (배치 4 x 누적 4 -> 페이징 횟수 감소)
         remove_unused_columns=False,        # VLM 데이터셋 컬럼 유지
+        group_by_length=True,               # 이미지 면적이 비슷한 샘플끼리 배치 구성
+        length_column_name="image_area",
+        torch_compile=True,                 # NF4 dequant + matmul 융합 (Trainer가 quantized 모델 compile 처리)
+        torch_compile_mode="max-autotune-no-cudagraphs",
         report_to="none",                   
         dataloader_pin_memory=False,        # 윈도우에서 가끔 오류 발생 방지
-        dataloader_num_workers=0
+        dataloader_num_workers=2,           # collator CPU 작업을 GPU 스텝과 병렬로 처리
+        dataloader_persistent_workers=True, # epoch마다 워커 재생성 방지 (윈도우 spawn 비용)
     )
 
     trainer = Trainer(
         model=model,
         args=training_args,
         train_dataset=dataset,
-        data_collator=Qwen2VLDataCollator(processor),
+        data_collator=Qwen2VLDataCollator(processor, CACHE_DIR),
     )
 
     # Do training
     print(">>> 학습 시작! (시간이 좀 걸립니다...)")
-    trainer.train()
+    # 이미지 크기에 따라 shape이 달라지므로 dynamo 재컴파일 캐시 한도를 늘림
+    torch._dynamo.config.cache_size_limit = 10000
+    try:
+        trainer.train()
+    except Exception as e:
+        # torch.compile은 lazy라서 컴파일 오류는 첫 스텝에서 발생 -> eager로 다시 학습
+        print(f"Warning: torch.compile 학습 실패. eager 모드로 다시 학습합니다. Error: {e}")
+        disable_torch_compile(training_args)
+        trainer = Trainer(
+            model=model,
+            args=training_args,
+            train_dataset=trainer.train_dataset,
+            data_collator=trainer.data_collator,
+        )
+        trainer.train()
     
     # Save final model
     print(f">>> 학습 완료! 모델 저장 중: {OUTPUT_DIR}")
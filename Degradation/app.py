@@ -1,8 +1,12 @@
 import streamlit as st
 import os
+import tempfile
 
 # 0. 상수 및 하이퍼파라미터 설정
 ADAPTER_PATH = "checkpoints/qlora/qwen2-vl-agent-checkpoint"
+MAX_BATCH = 4        # micro-batch 최대 크기
+BATCH_WINDOW = 0.03  # 요청을 모으는 대기 시간 (30ms)
+PREVIEW_SIZE = (1024, 1024)  # 미리보기 최대 크기
 
 # 1. 페이지 기본 설정
 st.set_page_config(
@@ -31,13 +35,15 @@ def get_ai_service():
     이후에는 이미 로드된 인스턴스를 반환합니다.
     """
     # lazy import : 일반 import시 stremlit 캐싱 문제 발생함
-    from main import ImageAnalysisService, create_workflow
+    from main import ImageAnalysisService, InferenceBatcher, create_workflow
 
     with st.spinner("AI 모델을 GPU(RTX 3070 Ti)에 로드 중입니다... 잠시만 기다려주세요."):
         # 3070 Ti 메모리 최적화를 위해 로드
         # QLoRA 어댑터 사용시 명시적으로 경로를 주입해 둬야한다.
         service = ImageAnalysisService(adapter_path=ADAPTER_PATH)
-        return service, create_workflow
+        # 세션 간 동시 요청을 모아서 한 번에 추론 (모든 세션이 같은 batcher 공유)
+        batcher = InferenceBatcher(service, max_batch=MAX_BATCH, batch_window=BATCH_WINDOW)
+        return service, batcher, create_workflow
 
 
 # 3. Sidebar 생성
@@ -47,8 +53,8 @@ use_qlora = True
 with st.sidebar:
     st.header("System Status")
     try:
-        ai_service, create_workflow_func = get_ai_service()
-        workflow_app = create_workflow_func(ai_service)
+        ai_service, ai_batcher, create_workflow_func = get_ai_service()
+        workflow_app = create_workflow_func(ai_batcher)
         st.success("✅ Model Loaded (Warm State)")
         st.info(f"Device: {ai_service.device}")
     except Exception as e:
@@ -78,15 +84,9 @@ with col1:
     uploaded_file = st.file_uploader("분석할 이미지를 선택하세요", type=["jpg", "png", "jpeg"])
 
     if uploaded_file is not None:
-        # 업로드된 파일을 임시 경로에 저장
-        os.makedirs("temp", exist_ok=True)
-        temp_path = os.path.join("temp", uploaded_file.name)
-        
-        with open(temp_path, "wb") as f:
-            f.write(uploaded_file.getbuffer())
-        
-        # 이미지 미리보기
+        # 이미지 미리보기 (UploadedFile은 이미 메모리 버퍼 -> 복사 없이 바로 열고, 축소본만 표시해서 인코딩 비용 절감)
         image = Image.open(uploaded_file)
+        image.thumbnail(PREVIEW_SIZE)
         st.image(image, caption="Uploaded Image", use_container_width=True)
 
 with col2:
@@ -102,7 +102,16 @@ with col2:
 
         if analyze_btn:
             with st.spinner(f"AI가 이미지를 분석하고 있습니다... ({model_mode})"):
+                temp_path = None
                 try:
+                    # 업로드된 파일을 요청별 임시 파일로 저장 (모델은 파일 경로로 이미지를 읽음)
+                    # 세션마다 고유 경로 -> 같은 파일명을 동시에 올려도 batcher에서 서로 덮어쓰지 않음
+                    os.makedirs("temp", exist_ok=True)
+                    suffix = os.path.splitext(uploaded_file.name)[1]
+                    with tempfile.NamedTemporaryFile(dir="temp", suffix=suffix, delete=False) as f:
+                        f.write(uploaded_file.getbuffer())
+                        temp_path = f.name
+
                     # LangGraph 워크플로우 실행
                     inputs = {"image_path": temp_path,
                               "use_custom_model": use_qlora
@@ -124,6 +133,11 @@ with col2:
                         
                 except Exception as e:
                     st.error(f"분석 중 오류 발생: {e}")
+
+                finally:
+                    # 분석이 끝나면 임시 파일 삭제
+                    if temp_path is not None and os.path.exists(temp_path):
+                        os.remove(temp_path)
                     
     else:
         st.info("왼쪽에서 이미지를 먼저 업로드해주세요.")
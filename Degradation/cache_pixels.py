@@ -0,0 +1,79 @@
+import os
+import json
+import hashlib
+import torch
+from typing import Dict, List
+
+from transformers import AutoProcessor
+from qwen_vl_utils import fetch_image
+
+# Hyper parameters
+MODEL_ID = "Qwen/Qwen2-VL-2B-Instruct"
+DATA_FILE = "./Degradation/train_data_augmented.json"
+CACHE_DIR = "./Degradation/pixel_cache"  # 이미지 1장당 .pt 파일 1개
+
+# 학습 데이터의 이미지 경로 수집
+def collect_image_paths(data_file: str) -> List[str]:
+    """JSON 데이터셋에서 중복 없이 이미지 경로를 수집합니다."""
+    with open(data_file, "r", encoding="utf-8") as f:
+        data = json.load(f)
+
+    image_paths = {
+        item["image"]
+        for entry in data
+        for msg in entry["messages"] if isinstance(msg["content"], list)
+        for item in msg["content"] if item.get("type") == "image"
+    }
+    return sorted(image_paths)
+
+def cache_file_for(image_path: str, cache_dir: str = CACHE_DIR) -> str:
+    """이미지 경로 -> 캐시 파일 경로 (경로 해시를 파일명으로 사용)"""
+    name = hashlib.blake2b(image_path.encode("utf-8"), digest_size=16).hexdigest()
+    return os.path.join(cache_dir, f"{name}.pt")
+
+def build_pixel_cache(image_paths: List[str], processor: AutoProcessor, cache_dir: str = CACHE_DIR) -> None:
+    """
+    이미지 디코딩 + resize + normalize를 미리 수행해서
+    pixel_values, image_grid_thw를 이미지별 파일로 저장합니다.
+    (epoch마다 같은 이미지를 다시 디코딩하지 않도록)
+    pixel_values는 bf16으로 저장해서 파일 크기를 절반으로 줄입니다.
+    캐시가 없거나 원본 이미지보다 오래된 경우만 다시 생성합니다.
+    (create_dataset.py가 noise_*.jpg를 같은 이름으로 다시 쓰므로 mtime으로 비교)
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+
+    stale = [
+        path for path in image_paths
+        if not os.path.exists(cache_file_for(path, cache_dir))
+        or os.path.getmtime(cache_file_for(path, cache_dir)) < os.path.getmtime(path)
+    ]
+    if not stale:
+        return
+
+    print(f">>> 픽셀 캐시 생성: {len(stale)}장 -> {cache_dir}")
+    for i, path in enumerate(stale):
+        # qwen-vl-utils와 동일한 resize 적용
+        outputs = processor.image_processor(images=[fetch_image({"image": path})], return_tensors="pt")
+        torch.save(
+            {
+                "pixel_values": outputs["pixel_values"].to(torch.bfloat16),
+                "image_grid_thw": outputs["image_grid_thw"],
+            },
+            cache_file_for(path, cache_dir),
+        )
+        if (i + 1) % 100 == 0:
+            print(f"   -> {i + 1}/{len(stale)} 처리 완료")
+
+def load_cached_pixels(image_path: str, cache_dir: str = CACHE_DIR) -> Dict[str, torch.Tensor]:
+    """
+    이미지 1장의 캐시를 mmap으로 로드합니다.
+    dataloader 워커마다 전체 캐시를 복사하지 않고 필요한 이미지만 읽습니다.
+    """
+    return torch.load(cache_file_for(image_path, cache_dir), mmap=True, weights_only=True)
+
+if __name__ == "__main__":
+    processor = AutoProcessor.from_pretrained(MODEL_ID)
+    image_paths = collect_image_paths(DATA_FILE)
+    print(f"📂 픽셀 캐시 생성을 시작합니다... ({len(image_paths)}장)")
+    build_pixel_cache(image_paths, processor)
+    print(f"\n✅ 완료! '{CACHE_DIR}'에 저장되었습니다.")
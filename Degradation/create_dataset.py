@@ -1,7 +1,9 @@
 import os
-import json
 import random
+import hashlib
+import orjson
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
 
 # Hyper parameters
@@ -31,25 +33,36 @@ LABELING_MAP = {
 
 OUTPUT_FILE = "train_data_augmented.json"
 
+# 노이즈 생성용 시드 (재현성 확보를 위해 고정, 이미지별 난수 생성기의 기준값)
+NOISE_SEED = 42
+
+# 이미지 디코딩/인코딩(libjpeg, libpng)은 GIL을 놓으므로 스레드로 병렬 처리
+MAX_WORKERS = 8
+
 # 가우시안 노이즈 추가로 노이즈 데이터셋 생성
-def add_gaussian_noise(image_path, save_path, mean=0, sigma=25):
+def add_gaussian_noise(image_path, save_path, rng, mean=0, sigma=25):
     """
     이미지를 읽어 가우시안 노이즈를 추가하고 저장합니다.
     sigma 값으로 노이즈의 강도를 조절합니다.
+    rng는 이미지별로 넘겨서 스레드 간 공유 없이 처리 순서와 무관하게 재현되도록 합니다.
     """
     try:
         # 이미지 로드 및 배열 변환
         img = Image.open(image_path).convert("RGB")
         img_array = np.array(img)
 
-        # 노이즈 생성 (이미지와 같은 크기)
-        gauss = np.random.normal(mean, sigma, img_array.shape)
+        # 노이즈 생성 (이미지와 같은 크기, float32 -> float64 대비 메모리 절반)
+        gauss = rng.standard_normal(img_array.shape, dtype=np.float32)
+        gauss *= sigma
+        gauss += mean
         
-        # 이미지에 노이즈 더하기
-        noisy_img_array = img_array + gauss
+        # 이미지에 노이즈 더하기 (float32 버퍼 하나에서 in-place 연산, 임시 배열 X)
+        buf = img_array.astype(np.float32)
+        np.add(buf, gauss, out=buf)
         
         # 0~255 사이 값으로 자르기 (Clip) 및 정수형 변환
-        noisy_img_array = np.clip(noisy_img_array, 0, 255).astype('uint8')
+        np.clip(buf, 0, 255, out=buf)
+        noisy_img_array = buf.astype(np.uint8, copy=False)
         
         # 이미지 저장
         noisy_img = Image.fromarray(noisy_img_array)
@@ -60,11 +73,18 @@ def add_gaussian_noise(image_path, save_path, mean=0, sigma=25):
         print(f"⚠️ 노이즈 생성 실패 ({image_path}): {e}")
         return False
 
+# 중복 이미지 검사용 해시 (blake2b: sha256보다 빠름)
+def file_hash(image_path):
+    """파일 내용 기준 해시를 반환합니다. (파일명이 달라도 같은 이미지면 같은 해시)"""
+    with open(image_path, "rb") as f:
+        return hashlib.blake2b(f.read(), digest_size=16).hexdigest()
+
 # =========================================================
 # 3. 데이터셋 생성 로직
 # =========================================================
 def create_dataset():
     final_data = []
+    seen_hashes = set()  # 폴더 간 중복까지 제거
     
     valid_extensions = {'.jpg', '.jpeg', '.png', '.bmp', '.webp'}
 
@@ -78,6 +98,21 @@ def create_dataset():
             continue
             
         images = [f for f in os.listdir(folder_path) if os.path.splitext(f)[1].lower() in valid_extensions]
+
+        # 내용이 같은 이미지는 한 번만 사용
+        # 해시 계산(파일 읽기)은 스레드로 병렬 처리, 중복 판정은 입력 순서대로 -> 결과가 항상 동일
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            hashes = list(executor.map(file_hash, [os.path.join(folder_path, f) for f in images]))
+
+        unique_images = []
+        for img_file, h in zip(images, hashes):
+            if h not in seen_hashes:
+                seen_hashes.add(h)
+                unique_images.append(img_file)
+        if len(unique_images) < len(images):
+            print(f"   -> [{folder_name}] 중복 이미지 {len(images) - len(unique_images)}장 제외")
+        images = unique_images
+
         print(f"   -> [{folder_name}] 처리 중... ({len(images)}장)")
 
         if degradation_type == "denoise":
@@ -88,30 +123,42 @@ def create_dataset():
         else:
             noise_save_dir = None
 
-        for img_file in images:
+        def process_one(indexed_file):
+            """이미지 1장 처리 -> 해당 이미지의 JSON 엔트리 리스트 반환"""
+            index, img_file = indexed_file
+            entries = []
+
             # 원본 이미지 경로 -> 절대경로
             src_path = os.path.join(folder_path, img_file).replace("\\", "/")            
 
             if degradation_type == "denoise":
                 # 1. Clean 원본 데이터 추가
-                add_entry(final_data, src_path, "Clean")
+                add_entry(entries, src_path, "Clean")
                 
                 # 2. Gaussian Noise 생성 및 데이터 추가
                 noise_filename = f"noise_{img_file}"
                 full_save_path = os.path.join(noise_save_dir, noise_filename)
                 
                 sigma = 25
-                if add_gaussian_noise(src_path, full_save_path, sigma=sigma):
+                image_rng = np.random.default_rng([NOISE_SEED, index])
+                if add_gaussian_noise(src_path, full_save_path, image_rng, sigma=sigma):
                     noise_path = full_save_path.replace("\\", "/")
-                    add_entry(final_data, noise_path, "Gaussian Noise")
+                    add_entry(entries, noise_path, "Gaussian Noise")
                     
             # denoise 외
             else:
-                add_entry(final_data, src_path, degradation_type)
+                add_entry(entries, src_path, degradation_type)
+
+            return entries
+
+        # map은 입력 순서대로 결과를 돌려주므로 JSON 순서는 기존과 동일
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            for entries in executor.map(process_one, enumerate(images)):
+                final_data.extend(entries)
 
-    # JSON 파일 저장
-    with open(OUTPUT_FILE, "w", encoding="utf-8") as f:
-        json.dump(final_data, f, indent=2, ensure_ascii=False)
+    # JSON 파일 저장 (orjson: C 구현, UTF-8 바이트로 바로 출력)
+    with open(OUTPUT_FILE, "wb") as f:
+        f.write(orjson.dumps(final_data, option=orjson.OPT_INDENT_2))
         
     print(f"\n✅ 완료! 총 {len(final_data)}개의 데이터 쌍이 '{OUTPUT_FILE}'에 저장되었습니다.")
 
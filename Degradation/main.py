@@ -1,11 +1,22 @@
 import torch
 import os
+import re
+import time
+import queue
+import threading
 
 from PIL import Image
-from transformers import Qwen2VLForConditionalGeneration, AutoProcessor
-from qwen_vl_utils import process_vision_info
+from transformers import (
+    Qwen2VLForConditionalGeneration,
+    AutoProcessor,
+    BitsAndBytesConfig,
+    StoppingCriteria,
+    StoppingCriteriaList
+)
+from qwen_vl_utils import fetch_image
 from peft import PeftModel
-from typing import TypedDict, Optional
+from typing import TypedDict, Optional, List
+from concurrent.futures import Future
 from langgraph.graph import StateGraph, END
 
 # 1. State 정의 (데이터 DTO 역할)
@@ -15,6 +26,31 @@ class AgentState(TypedDict):
     analysis_result: Optional[str]
     final_report: Optional[str]
 
+# 분석 프롬프트 (고정) -> 서비스 초기화 시 1회만 토크나이즈
+ANALYSIS_PROMPT = (
+    "Analyze this image technically. "
+    "Does this image have any quality degradation? "
+    "Check for Blur, Gaussian Noise, JPEG Compression artifacts, or Low Resolution. "
+    "Answer in this format:\n"
+    "- Degradation Detected: [Yes/No]\n"
+    "- Type: [Type or None]\n"
+    "- Severity: [Low/Medium/High]\n"
+    "- Description: [Brief explanation]"
+)
+IMAGE_PAD_TOKEN = "<|image_pad|>"
+
+# 생성 종료 조건 (리포트 마지막 항목인 Description 라인이 끝나면 중단)
+class ReportEndStoppingCriteria(StoppingCriteria):
+    def __init__(self, tokenizer, prompt_length: int):
+        self.tokenizer = tokenizer
+        self.prompt_length = prompt_length
+        self.pattern = re.compile(r"- Description:[^\n]*\n")
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        # 새로 생성된 토큰만 디코딩해서 배치 내 샘플별로 종료 여부 판단
+        texts = self.tokenizer.batch_decode(input_ids[:, self.prompt_length:], skip_special_tokens=True)
+        return torch.tensor([bool(self.pattern.search(text)) for text in texts], device=input_ids.device)
+
 # 2. AI Service Class (모델 관리 및 추론 담당)
 class ImageAnalysisService:
     def __init__(self, model_id: str = "Qwen/Qwen2-VL-2B-Instruct", adapter_path: Optional[str] = None, device: str = "cuda"):
@@ -26,6 +62,10 @@ class ImageAnalysisService:
         self.model_id = model_id
         self.model = None
         self.processor = None
+        self.pad_token_id = None
+        self.image_pad_id = None
+        self._prompt_prefix_ids = None
+        self._prompt_suffix_ids = None
         self.adapter_path = adapter_path
         
         print(f"[{self.__class__.__name__}] 모델 초기화 시작... Target Device: {self.device}")
@@ -35,11 +75,23 @@ class ImageAnalysisService:
     def _load_model(self):
         """내부 메서드: 실제 모델 로딩 로직"""
         #todo: flash attention 적용, window에서..
+        # 4-bit 양자화 (학습과 동일한 NF4 설정) -> 가중치 VRAM 절반, QLoRA 어댑터는 그대로 부착
+        # compute/storage dtype은 모델 dtype과 맞춤 (호환 모드는 fp16)
+        def make_bnb_config(dtype):
+            return BitsAndBytesConfig(
+                load_in_4bit=True,
+                bnb_4bit_quant_type="nf4",
+                bnb_4bit_compute_dtype=dtype,
+                bnb_4bit_use_double_quant=True,
+                bnb_4bit_quant_storage=dtype,
+            )
+
         try:
             # RTX 3070 Ti (Ampere) -> bfloat16 지원 + Flash Attention 권장
             base_model = Qwen2VLForConditionalGeneration.from_pretrained(
                 self.model_id,
                 torch_dtype=torch.bfloat16,
+                quantization_config=make_bnb_config(torch.bfloat16),
                 device_map=self.device,
                 attn_implementation="flash_attention_2"
             )
@@ -48,10 +100,14 @@ class ImageAnalysisService:
             base_model = Qwen2VLForConditionalGeneration.from_pretrained(
                 self.model_id,
                 torch_dtype=torch.float16,
+                quantization_config=make_bnb_config(torch.float16),
                 device_map=self.device
             )
         
         self.processor = AutoProcessor.from_pretrained(self.model_id)
+        # 매 요청마다 tokenizer 속성 조회하지 않도록 int로 캐싱 (pad는 eos로 대체)
+        self.pad_token_id = int(self.processor.tokenizer.eos_token_id)
+        self._cache_prompt_tokens()
 
         # PEFT QLora 추가
         if self.adapter_path and os.path.exists(self.adapter_path):
@@ -62,71 +118,169 @@ class ImageAnalysisService:
             self.model = base_model
 
 
-    def analyze_image(self, image_path: str, use_custom_model: bool) -> str:
+    def _cache_prompt_tokens(self):
         """
-        실제 추론(Inference)을 수행하는 메서드
-        use_custom_model 플래그에 따라 어댑터 활성여부 결정하도록 변경
+        내부 메서드: 고정 프롬프트를 이미지 토큰 앞/뒤로 나눠서 미리 토크나이즈
+        요청 시에는 이미지 토큰 개수만 채워서 이어붙입니다. (chat template/토크나이저 호출 X)
         """
-        prompt = (
-            "Analyze this image technically. "
-            "Does this image have any quality degradation? "
-            "Check for Blur, Gaussian Noise, JPEG Compression artifacts, or Low Resolution. "
-            "Answer in this format:\n"
-            "- Degradation Detected: [Yes/No]\n"
-            "- Type: [Type or None]\n"
-            "- Severity: [Low/Medium/High]\n"
-            "- Description: [Brief explanation]"
-        )
-
         messages = [
             {
                 "role": "user",
                 "content": [
-                    {"type": "image", "image": image_path},
-                    {"type": "text", "text": prompt},
+                    {"type": "image"},
+                    {"type": "text", "text": ANALYSIS_PROMPT},
                 ],
             }
         ]
-
-        # 전처리
         text = self.processor.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
-        image_inputs, video_inputs = process_vision_info(messages)
-        inputs = self.processor(
-            text=[text],
-            images=image_inputs,
-            videos=video_inputs,
-            padding=True,
-            return_tensors="pt",
-        )
-        inputs = inputs.to(self.device)
+        prefix, suffix = text.split(IMAGE_PAD_TOKEN)
+
+        tokenizer = self.processor.tokenizer
+        self.image_pad_id = tokenizer.convert_tokens_to_ids(IMAGE_PAD_TOKEN)
+        self._prompt_prefix_ids = torch.tensor(tokenizer(prefix, add_special_tokens=False)["input_ids"])
+        self._prompt_suffix_ids = torch.tensor(tokenizer(suffix, add_special_tokens=False)["input_ids"])
 
-        output_text = ""
+    def _generate(self, inputs: dict, max_new_tokens: int = 96) -> torch.Tensor:
+        """
+        내부 메서드: greedy + KV cache로 생성
+        리포트는 ~60 토큰 고정 형식이므로 Description 라인이 끝나면 바로 중단합니다.
+        """
+        stopping_criteria = StoppingCriteriaList([
+            ReportEndStoppingCriteria(self.processor.tokenizer, inputs["input_ids"].shape[1])
+        ])
+        with torch.inference_mode():
+            return self.model.generate(
+                **inputs,
+                max_new_tokens=max_new_tokens,
+                do_sample=False,
+                num_beams=1,
+                use_cache=True,
+                pad_token_id=self.pad_token_id,
+                stopping_criteria=stopping_criteria,
+                return_dict_in_generate=False,
+            )
+
+    def analyze_image(self, image_path: str, use_custom_model: bool) -> str:
+        """
+        실제 추론(Inference)을 수행하는 메서드
+        use_custom_model 플래그에 따라 어댑터 활성여부 결정하도록 변경
+        """
+        return self.analyze_images([image_path], use_custom_model)[0]
+
+    def analyze_images(self, image_paths: List[str], use_custom_model: bool) -> List[str]:
+        """
+        여러 이미지를 한 번의 generate로 배치 추론합니다. (left padding)
+        InferenceBatcher가 동시 요청을 묶어서 호출합니다.
+        """
+        # 전처리: 이미지만 processor로 변환 (qwen-vl-utils와 동일한 resize 적용)
+        image_inputs = [fetch_image({"image": image_path}) for image_path in image_paths]
+        image_outputs = self.processor.image_processor(images=image_inputs, return_tensors="pt")
+
+        # 캐싱된 프롬프트 토큰 + 이미지 크기만큼의 이미지 토큰 (processor와 동일한 확장 규칙)
+        merge_length = self.processor.image_processor.merge_size ** 2
+        sequences = [
+            torch.cat([
+                self._prompt_prefix_ids,
+                torch.full((int(grid_thw.prod()) // merge_length,), self.image_pad_id),
+                self._prompt_suffix_ids,
+            ])
+            for grid_thw in image_outputs["image_grid_thw"]
+        ]
+
+        # left padding (배치 생성 시 프롬프트 끝이 정렬되도록)
+        max_len = max(len(seq) for seq in sequences)
+        input_ids = torch.full((len(sequences), max_len), self.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros_like(input_ids)
+        for i, seq in enumerate(sequences):
+            input_ids[i, max_len - len(seq):] = seq
+            attention_mask[i, max_len - len(seq):] = 1
+
+        inputs = {
+            "input_ids": input_ids,
+            "attention_mask": attention_mask,
+            "pixel_values": image_outputs["pixel_values"],
+            "image_grid_thw": image_outputs["image_grid_thw"],
+        }
+        # pinned memory + non_blocking -> H2D 복사를 generate 준비 과정과 겹쳐서 수행
+        if torch.cuda.is_available():
+            inputs = {k: v.pin_memory() if torch.is_tensor(v) else v for k, v in inputs.items()}
+        inputs = {k: v.to(self.device, non_blocking=True) if torch.is_tensor(v) else v for k, v in inputs.items()}
 
         if use_custom_model and isinstance(self.model, PeftModel):
-            print(f"Custom QLoRA 모델 사용")
-            with torch.no_grad():
-                generated_ids = self.model.generate(**inputs, max_new_tokens=256)
+            print(f"Custom QLoRA 모델 사용 (batch={len(image_paths)})")
+            generated_ids = self._generate(inputs)
 
         elif not use_custom_model and isinstance(self.model, PeftModel):
-            print(f"Basemodel 사용 (QLoRA 비활성화)")
+            print(f"Basemodel 사용 (QLoRA 비활성화, batch={len(image_paths)})")
             with self.model.disable_adapter():
-                with torch.no_grad():
-                    generated_ids = self.model.generate(**inputs, max_new_tokens=256)
+                generated_ids = self._generate(inputs)
 
         else:
             # Base model only
-            with torch.no_grad():
-                generated_ids = self.model.generate(**inputs, max_new_tokens=256)
+            generated_ids = self._generate(inputs)
 
         # 후처리 (Decoding)
-        generated_ids_trimmed = [
-            out_ids[len(in_ids):] for in_ids, out_ids in zip(inputs.input_ids, generated_ids)
-        ]
-        output_text = self.processor.batch_decode(
+        # left padding이라 모든 샘플의 프롬프트 길이가 같음 -> 텐서 슬라이스 한 번으로 잘라냄
+        generated_ids_trimmed = generated_ids[:, inputs["input_ids"].shape[1]:]
+        return self.processor.batch_decode(
             generated_ids_trimmed, skip_special_tokens=True, clean_up_tokenization_spaces=False
-        )[0]
-        
-        return output_text
+        )
+
+# 2-1. Micro-batching (동시 요청을 모아서 한 번의 generate로 처리)
+class InferenceBatcher:
+    def __init__(self, service: ImageAnalysisService, max_batch: int = 4, batch_window: float = 0.03):
+        """
+        ImageAnalysisService 앞단의 요청 큐입니다.
+        Streamlit 세션은 각자 별도 스레드에서 실행되므로 asyncio 대신 스레드 큐를 사용합니다.
+        analyze_image 시그니처가 서비스와 동일해서 워크플로우에 그대로 주입할 수 있습니다.
+        """
+        self.service = service
+        self.device = service.device
+        self.max_batch = max_batch
+        self.batch_window = batch_window
+        self._queue = queue.Queue()
+
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    def analyze_image(self, image_path: str, use_custom_model: bool) -> str:
+        """요청을 큐에 넣고 배치 추론 결과를 기다립니다."""
+        future = Future()
+        self._queue.put((image_path, use_custom_model, future))
+        return future.result()
+
+    def _collect_batch(self) -> list:
+        """내부 메서드: 첫 요청 이후 batch_window 동안 최대 max_batch개까지 요청을 모음"""
+        requests = [self._queue.get()]
+        deadline = time.monotonic() + self.batch_window
+        while len(requests) < self.max_batch:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                requests.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return requests
+
+    def _run(self):
+        """내부 메서드: 워커 스레드 루프 (GPU 추론은 이 스레드에서만 수행)"""
+        while True:
+            requests = self._collect_batch()
+
+            # 어댑터 on/off는 배치 단위로만 바꿀 수 있으므로 플래그별로 나눠서 추론
+            for use_custom_model in (True, False):
+                group = [r for r in requests if r[1] == use_custom_model]
+                if not group:
+                    continue
+                try:
+                    results = self.service.analyze_images([r[0] for r in group], use_custom_model)
+                except Exception as e:
+                    for _, _, future in group:
+                        future.set_exception(e)
+                    continue
+                for (_, _, future), result in zip(group, results):
+                    future.set_result(result)
 
 # 3. main workflow
 def create_workflow(service_instance: ImageAnalysisService):